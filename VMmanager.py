@@ -1,16 +1,21 @@
 #!/usr/bin/python3
 
+import errno
 import os
-from random import random
 import sys
-import socket
 import re
-import getpass
-import grp
-import argparse
-import subprocess
 import time
-import shutil
+import stat
+
+
+# Anchored, without capturing groups: a rejected input is a single left-to-right scan
+_VM_NAME_RE = re.compile(r'\A[a-zA-Z0-9_-]{1,32}\Z')
+_MAC_RE = re.compile(r'\A[a-fA-F0-9]{2}(?::[a-fA-F0-9]{2}){5}\Z')
+_SIZE_RE = re.compile(r'\A[1-9][0-9]*[MG]\Z')
+
+# Fixed part of kvm command lines, per-VM arguments are appended
+_KVM_RUN_ARGS = ('kvm', '-display', 'none', '-k', 'fr', '-netdev', 'bridge,id=hn0', '-daemonize')
+_KVM_INSTALL_ARGS = ('kvm', '-boot', 'd', '-k', 'fr', '-netdev', 'bridge,id=hn0')
 
 
 class VMmanagerException(Exception):
@@ -18,9 +23,23 @@ class VMmanagerException(Exception):
 
 
 class VMmanager:
-    def __init__(self, user):
+    # Positive kvm group checks are remembered across invocations until /etc/group changes
+    _AUTHZ_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'vmmanager', 'authz')
+    _AUTHZ_TTL = 3600
+
+    # Result of the last VMs scan, reused while VMs home, VM directories and mac_addr files are unchanged
+    _INDEX_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'vmmanager', 'index-{}.json')
+
+    # Seconds during which monitor probes are answered from memory
+    _RUNNING_TTL = 0.2
+
+    # Seconds given to a guest to power off before stop() fails or forces it
+    _STOP_TIMEOUT = 10
+
+    def __init__(self, user, cache_ttl=0):
         self.user = user
         self.vms_home = '/opt/VMs/' + user
+        self.cache_ttl = cache_ttl
 
         # Check VMs home directory
         if not os.path.isdir(self.vms_home):
@@ -29,45 +48,427 @@ class VMmanager:
         if not os.access(self.vms_home, os.W_OK):
             raise VMmanagerException(self.vms_home + " isn't writable.")
 
-        # Check groups
-        groups = [g.gr_name for g in grp.getgrall() if user in g.gr_mem]
-        if 'kvm' not in groups:
-            raise VMmanagerException(user + " isn't in kvm group.")
+        # Group membership and VMs are only resolved by the operations that need them
+        self._kvm_checked = False
+        self._vm_macs = None
+        self._paths = {}
+        self._dir_fds = {}
+        self._running = set()
+        self._running_checked = {}
+        self._mac_cache = {}
+        self._reserved_macs = set()
+        self._lock = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Release the VM directory descriptors held by this instance
+        :return: None
+        """
+        for fd in getattr(self, '_dir_fds', {}).values():
+            os.close(fd)
+        self._dir_fds = {}
+
+    @property
+    def vms(self):
+        """
+        VMs of the user, loaded on first access. Built from the internal tables on each access, changes to it are
+        not kept
+        :return: Dictionary of VM name to VM attributes
+        """
+        return {v: {'mac': mac} for v, mac in self._macs.items()}
+
+    @property
+    def _macs(self):
+        """
+        MAC address of each VM of the user, loaded on first access
+        :return: Dictionary of VM name to MAC address
+        """
+        if self._vm_macs is None:
+            self._load_vms()
+        return self._vm_macs
+
+    def _check_kvm_group(self):
+        """
+        Check that the user is in kvm group
+        :return: None
+        :raise: VMmanagerException if user isn't in kvm group
+        """
+        if self._kvm_checked:
+            return
+
+        import json
 
-        self.vms = {}
-        self._load_vms()
+        try:
+            group_mtime = os.stat('/etc/group').st_mtime_ns
+        except OSError:
+            group_mtime = None
 
-    def _load_vms(self):
+        try:
+            with open(self._AUTHZ_CACHE, 'r') as f:
+                authz = json.load(f)
+            if authz['user'] == self.user and authz['group_check_passed'] and authz['mtime'] == group_mtime \
+                    and time.time() - os.stat(self._AUTHZ_CACHE).st_mtime < self._AUTHZ_TTL:
+                self._kvm_checked = True
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        # Targeted lookups of kvm group and, if needed, user's primary group (no enumeration of user's groups)
+        import grp
+        import pwd
+        try:
+            kvm = grp.getgrnam('kvm')
+            in_kvm = self.user in kvm.gr_mem or pwd.getpwnam(self.user).pw_gid == kvm.gr_gid
+        except KeyError:
+            in_kvm = False
+        if not in_kvm:
+            raise VMmanagerException(self.user + " isn't in kvm group.")
+
+        self._kvm_checked = True
+
+        try:
+            os.makedirs(os.path.dirname(self._AUTHZ_CACHE), exist_ok=True)
+            with open(self._AUTHZ_CACHE, 'w') as f:
+                json.dump({'user': self.user, 'group_check_passed': True, 'mtime': group_mtime}, f)
+        except OSError:
+            pass
+
+    def _load_vms(self, use_index=True):
         """
-        Load VMs in self.vms
+        Load VMs in self._vm_macs and their running state in self._running
+        :param use_index: Reuse the last scan if no directory changed since (boolean)
         :return: None
         """
-        directory_content = os.listdir(self.vms_home)
-        for v in directory_content:
-            if not self._validate_vm_name(v):
-                continue
+        macs = {}
+        paths = {}
+        running = set()
 
-            if not os.path.isfile(self.vms_home + '/' + v + '/mac_addr'):
-                continue
+        # Directories may have been replaced since descriptors were opened
+        self.close()
 
-            with open(self.vms_home + '/' + v + '/mac_addr', 'r') as f:
-                mac = f.readline()
+        # Taken before listing, a change made during the scan leaves a newer time than the recorded one
+        home_mtime = os.stat(self.vms_home).st_mtime_ns
 
-            if not self._validate_mac_addr(mac):
+        index = self._read_index(home_mtime) if use_index else None
+        if index is not None:
+            candidates, results = index
+        else:
+            # DirEntry.is_dir() and inode() come from the directory listing, no extra stat.
+            # Probing in inode order keeps the inode table reads mostly sequential.
+            with os.scandir(self.vms_home) as it:
+                entries = sorted((e for e in it if e.is_dir() and self._validate_vm_name(e.name)),
+                                 key=lambda e: e.inode())
+            candidates = tuple(e.name for e in entries)
+
+            # Per-VM probes are latency bound on network filesystems, overlap them for large homes
+            if len(candidates) > 8:
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(max_workers=min(16, len(candidates))) as executor:
+                    results = list(executor.map(self._load_vm, candidates))
+            else:
+                results = [self._load_vm(v) for v in candidates]
+
+            self._write_index(home_mtime, candidates, results)
+
+        for v, r in zip(candidates, results):
+            if r is None or r[1] is None:
                 continue
 
-            self.vms[v] = {'mac': mac}
+            vm_dir, mac, is_running = r[:3]
+            macs[v] = mac
+            paths[v] = vm_dir
+            if is_running:
+                running.add(v)
+
+        self._vm_macs = macs
+        self._paths = paths
+        self._running = running
+
+        for v in set(self._mac_cache) - set(macs):
+            self._mac_cache.pop(v)
+
+    def _load_vm(self, name):
+        """
+        Probe a VM directory
+        :param name: VM name (string)
+        :return: Tuple (directory, MAC address, running, directory mtime, mac_addr (mtime, inode)).
+        MAC address is None if it isn't a valid VM, mac_addr stamp is None if it isn't a regular file.
+        None if the directory can't be read
+        """
+        vm_dir = self._vm_dir(name)
+
+        try:
+            mtime = os.stat(vm_dir).st_mtime_ns
+        except OSError:
+            return None
+
+        names = self._scan_vm_dir(vm_dir)
+        if names is None:
+            return None
+        if 'mac_addr' not in names:
+            return vm_dir, None, False, mtime, None
+
+        mac = self._read_mac(name)
+        if mac is None or not self._validate_mac_addr(mac):
+            mac = None
+
+        # _read_mac leaves the stamp of the mac_addr it read in the cache
+        cached = self._mac_cache.get(name)
+        return vm_dir, mac, 'monitor' in names, mtime, cached[1] if cached is not None else None
+
+    def _read_index(self, home_mtime):
+        """
+        Read the last scan of VMs home if it is still up to date
+        Directory times catch added or removed entries, mac_addr files rewritten in place are caught by their own stamp
+        :param home_mtime: Current modification time of VMs home (int)
+        :return: Tuple (candidates, results) as built by a scan, None if there is no up to date index
+        """
+        import json
+
+        try:
+            with open(self._INDEX_CACHE.format(self.user), 'r') as f:
+                index = json.load(f)
+            if index['home'] != self.vms_home or index['mtime'] != home_mtime:
+                return None
+
+            now = time.monotonic()
+            candidates = tuple(index['vms'])
+            results = []
+            for v in candidates:
+                mtime, mac, is_running, mac_stamp = index['vms'][v]
+                if not self._validate_vm_name(v) or (mac is not None and not self._validate_mac_addr(mac)):
+                    return None
+                vm_dir = self._vm_dir(v)
+                if os.stat(vm_dir).st_mtime_ns != mtime:
+                    return None
+                if mac_stamp is not None:
+                    st = os.stat(vm_dir + '/mac_addr')
+                    mac_stamp = (st.st_mtime_ns, st.st_ino)
+                    if list(mac_stamp) != index['vms'][v][3]:
+                        return None
+                    self._mac_cache[v] = (now, mac_stamp, mac)
+                results.append((vm_dir, mac, is_running, mtime, mac_stamp))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        return candidates, results
+
+    def _write_index(self, home_mtime, candidates, results):
+        """
+        Save a scan of VMs home for the next invocations
+        :param home_mtime: Modification time of VMs home taken before the scan (int)
+        :param candidates: Scanned VM directories (tuple of strings)
+        :param results: _load_vm() result of each candidate (list)
+        :return: None
+        """
+        # Timestamps have a limited granularity, a change made in the same tick as a recorded time would go unnoticed
+        limit = time.time_ns() - 1000000000
+        if home_mtime >= limit or any(r is None or r[3] >= limit or (r[4] is not None and r[4][0] >= limit)
+                                      for r in results):
+            return
+
+        import json
+
+        path = self._INDEX_CACHE.format(self.user)
+        tmp = '{}.{}'.format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump({'home': self.vms_home, 'mtime': home_mtime,
+                           'vms': {v: [r[3], r[1], r[2], r[4]] for v, r in zip(candidates, results)}}, f)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _scan_vm_dir(self, vm_dir):
+        """
+        List a VM directory once, so that file probes become set lookups
+        :param vm_dir: VM directory (string)
+        :return: Set of entry names, None if the directory can't be read
+        """
+        try:
+            with os.scandir(vm_dir) as it:
+                return {e.name for e in it}
+        except OSError:
+            return None
 
-    def is_running(self, vm):
+    def refresh(self):
+        """
+        Rescan VMs home directory to pick up changes made outside of this instance, discarding the saved scan
+        :return: None
+        """
+        try:
+            os.remove(self._INDEX_CACHE.format(self.user))
+        except OSError:
+            pass
+        self._load_vms(use_index=False)
+
+    def _vm_dir(self, name):
+        """
+        Return the directory of a VM
+        :param name: VM name (string)
+        :return: Path (string)
+        """
+        path = self._paths.get(name)
+        if path is None:
+            path = self._paths[name] = self.vms_home + '/' + name
+        return path
+
+    def _vm_path(self, name, filename):
+        """
+        Return the path of a file in a VM directory
+        :param name: VM name (string)
+        :param filename: File name (string)
+        :return: Path (string)
+        """
+        return self._vm_dir(name) + '/' + filename
+
+    def _dir_fd(self, name):
+        """
+        Return a descriptor on a VM directory, opened on first use, so probes skip path resolution
+        :param name: VM name (string)
+        :return: File descriptor (int)
+        :raise: OSError if the directory can't be opened
+        """
+        fd = self._dir_fds.get(name)
+        if fd is None:
+            fd = os.open(self._vm_dir(name), getattr(os, 'O_PATH', os.O_RDONLY) | os.O_DIRECTORY)
+            self._dir_fds[name] = fd
+        return fd
+
+    def _overlays(self, name):
+        """
+        List the clones whose disk is an overlay backed by the disk of a VM
+        Each overlay clone leaves an 'overlay.<clone name>' marker in the directory of the VM it is backed by
+        :param name: VM name (string)
+        :return: Sorted list of VM names
+        """
+        names = self._scan_vm_dir(self._vm_dir(name)) or ()
+        return sorted(n[8:] for n in names if n.startswith('overlay.') and n[8:] in self._macs)
+
+    def _resolve(self, name, action):
+        """
+        Resolve an existing VM: open its directory once and probe its running state relative to it
+        :param name: VM name (string)
+        :param action: Operation name for error messages (string)
+        :return: Tuple (directory file descriptor, running)
+        :raise: VMmanagerException if VM doesn't exist
+        """
+        # Loaded names passed _validate_vm_name during the scan, so this also rejects invalid names
+        if name not in self._macs:
+            raise VMmanagerException("Could not {} VM: doesn't exist".format(action))
+
+        try:
+            dir_fd = self._dir_fd(name)
+        except FileNotFoundError:
+            raise VMmanagerException("Could not {} VM: doesn't exist".format(action))
+
+        return dir_fd, self.is_running(name)
+
+    def _vm_exists(self, name):
+        """
+        Check if a VM directory exists, without loading VMs
+        :param name: VM name (string)
+        :return: True if the directory exists, False otherwise
+        """
+        return os.path.exists(self._vm_dir(name))
+
+    def _read_mac(self, vm):
+        """
+        Read the MAC address of a VM, using the cached value while mac_addr is unchanged
+        :param vm: VM name (string)
+        :return: MAC address (string), None if mac_addr isn't a regular file
+        """
+        path = self._vm_path(vm, 'mac_addr')
+        now = time.monotonic()
+
+        cached = self._mac_cache.get(vm)
+        if cached is not None and now - cached[0] < self.cache_ttl:
+            return cached[2]
+
+        # With a cached value, stat first and only open the file if it changed since last read
+        if cached is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None and stat.S_ISREG(st.st_mode) and cached[1] == (st.st_mtime_ns, st.st_ino):
+                self._mac_cache[vm] = (now, cached[1], cached[2])
+                return cached[2]
+
+        # Otherwise open directly and fstat the descriptor, O_NONBLOCK so that a FIFO can't block us
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            self._mac_cache.pop(vm, None)
+            return None
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                self._mac_cache.pop(vm, None)
+                return None
+            # Raw read sized for a MAC address and line ending, bypassing buffered text IO
+            data = os.read(fd, 32)
+        finally:
+            os.close(fd)
+        mac = data.decode('ascii', 'replace').split('\n', 1)[0].rstrip()
+
+        self._mac_cache[vm] = (now, (st.st_mtime_ns, st.st_ino), mac)
+        return mac
+
+    def is_running(self, vm, refresh=True):
         """
         Check if a VM is running
         :param vm: VM name (string)
+        :param refresh: Probe the monitor socket, False to use the state from the last scan (boolean)
         :return: True if VM is running, False if VM is stopped or VM doesn't exist
         """
-        return os.path.exists(self.vms_home + '/' + vm + '/monitor')
-
-    def _run_command(self, cmd):
-        return subprocess.run(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if self._vm_macs is None:
+            self._load_vms()
+
+        if refresh and vm in self._vm_macs:
+            now = time.monotonic()
+            checked = self._running_checked.get(vm)
+            if checked is None or now - checked >= self._RUNNING_TTL:
+                # Single fstatat relative to the VM directory, the socket is never a symlink
+                try:
+                    os.stat('monitor', dir_fd=self._dir_fd(vm), follow_symlinks=False)
+                    self._running.add(vm)
+                except OSError:
+                    self._running.discard(vm)
+                self._running_checked[vm] = now
+
+        return vm in self._running
+
+    def _run_command(self, argv):
+        """
+        Run a command without going through a shell, discarding its output
+        :param argv: Program and its arguments (list of strings)
+        :return: Exit code (int)
+        """
+        if not hasattr(os, 'posix_spawnp'):
+            import subprocess
+            return subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+
+        import signal
+
+        # posix_spawn lets the kernel skip duplicating the interpreter's address space.
+        # Signals ignored by the interpreter are restored to default as subprocess does.
+        file_actions = [(os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+                        (os.POSIX_SPAWN_DUP2, 1, 2)]
+        pid = os.posix_spawnp(argv[0], argv, os.environ, file_actions=file_actions,
+                              setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        _, status = os.waitpid(pid, 0)
+        # Same convention as subprocess: negative signal number if killed
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
 
     def _validate_vm_name(self, name):
         """
@@ -75,10 +476,7 @@ class VMmanager:
         :param name: VM name (string)
         :return: True if ok, False otherwise
         """
-        regex = re.compile('[a-zA-Z0-9_-]{1,32}')
-        if regex.fullmatch(name) is None:
-            return False
-        return True
+        return _VM_NAME_RE.fullmatch(name) is not None
 
     def _validate_mac_addr(self, addr):
         """
@@ -86,10 +484,7 @@ class VMmanager:
         :param addr: MAC address (string)
         :return: True if ok, False otherwise
         """
-        regex = re.compile('([a-fA-F0-9]{2}:){5}[a-fA-F0-9]{2}')
-        if regex.fullmatch(addr) is None:
-            return False
-        return True
+        return _MAC_RE.fullmatch(addr) is not None
 
     def _validate_size(self, value):
         """
@@ -97,17 +492,59 @@ class VMmanager:
         :param value: Size (string)
         :return: True if ok, False otherwise
         """
-        regex = re.compile('[1-9][0-9]*[MG]')
-        if regex.fullmatch(value) is None:
-            return False
-        return True
+        return _SIZE_RE.fullmatch(value) is not None
+
+    def _parse_size(self, value):
+        """
+        Validate and convert a size in one pass, M and G being binary units as for qemu
+        :param value: Size (string) (ex: 20G)
+        :return: Size in bytes (int), None if invalid
+        """
+        digits = value[:-1]
+        if not digits or digits[0] == '0' or not (digits.isascii() and digits.isdigit()):
+            return None
+        unit = value[-1]
+        if unit == 'M':
+            return int(digits) << 20
+        if unit == 'G':
+            return int(digits) << 30
+        return None
 
     def _create_mac_addr(self):
         """
-        Return a mac address randomly generated
-        :return: String
+        Return a mac address randomly generated, distinct from the ones of existing VMs
+        :return: String, empty string if no address could be found
+        """
+        from random import random
+
+        used = {mac.lower() for mac in self._macs.values()}
+        used.update(self._reserved_macs)
+        for _ in range(256):
+            mac = '52:54:00:%02x:%02x:%02x' % (round(random() * 255), round(random() * 255), round(random() * 255))
+            if mac not in used:
+                # Not in self._vm_macs until the VM is written, keep concurrent creations from picking it
+                self._reserved_macs.add(mac)
+                return mac
+        return ''
+
+    def _locked(self, func, *args):
+        """
+        Call func(*args), holding the batch lock if a batch operation is running
+        :return: func return value
+        """
+        if self._lock is None:
+            return func(*args)
+        with self._lock:
+            return func(*args)
+
+    def _register_vm(self, name, vm_dir, mac):
+        """
+        Add a newly written VM to the loaded VMs
+        :return: None
         """
-        return '52:54:00:%02x:%02x:%02x' % (round(random() * 255), round(random() * 255), round(random() * 255))
+        if self._vm_macs is not None:
+            self._vm_macs[name] = mac
+            self._paths[name] = vm_dir
 
     def list(self, name=None, status=False):
         """
@@ -117,23 +554,19 @@ class VMmanager:
         :return: An array of dictionary representing a VM
         :raise: VMmanagerException if error occurs
         """
-        if name is not None and not self._validate_vm_name(name):
-            raise VMmanagerException("Could not list VM: Invalid name")
-
         vms_list = []
 
         if name is not None:
-            if name not in self.vms:
+            if name not in self._macs:
                 raise VMmanagerException("Could not list VM: doesn't exist")
-            vms = {name: self.vms[name]}
+            macs = ((name, self._macs[name]),)
         else:
-            vms = self.vms
-
-        for v in vms:
-            mac = vms[v]['mac']
+            macs = self._macs.items()
 
+        # Status from the scan, without a probe per VM
+        for v, mac in macs:
             if status:
-                vms_list.append({'name': v, 'mac': mac, 'status': 'RUNNING' if self.is_running(v) else 'STOPPED'})
+                vms_list.append({'name': v, 'mac': mac, 'status': 'RUNNING' if v in self._running else 'STOPPED'})
             else:
                 vms_list.append({'name': v, 'mac': mac})
 
@@ -150,111 +583,238 @@ class VMmanager:
         if not self._validate_vm_name(name):
             raise VMmanagerException("Could not create VM: Invalid name")
 
-        if not self._validate_size(disk_size):
-            raise VMmanagerException("Could not run VM: Invalid disk size")
+        disk_size_num = self._parse_size(disk_size)
+        if disk_size_num is None:
+            raise VMmanagerException("Could not create VM: Invalid disk size")
+        if disk_size_num > 50 << 30:
+            raise VMmanagerException("Could not create VM: disk can't be greater than 50 Go")
 
-        # Check existing VM
-        if os.path.exists(self.vms_home + '/' + name) or name in self.vms:
+        self._check_kvm_group()
+
+        vm_dir = self._vm_dir(name)
+
+        # Check existing VM (a loaded VM always has its directory, no need to load them all)
+        if self._vm_exists(name):
             raise VMmanagerException("Could not create VM: file already exist")
 
         # Generate MAC address
-        mac = self._create_mac_addr()
+        mac = self._locked(self._create_mac_addr)
         if mac == '':
             raise VMmanagerException("Could not create VM: no MAC address available (up to 255 VMs allowed)")
 
         # Create directory
-        os.mkdir(self.vms_home + '/' + name)
+        try:
+            os.mkdir(vm_dir)
+        except FileExistsError:
+            # Created concurrently since the check
+            raise VMmanagerException("Could not create VM: file already exist")
 
         # Create disk
-        disk_size_num = int(disk_size.replace('M', '').replace('G', ''))
-        disk_size_num *= 1000 if disk_size[:-1] == 'M' else 1000000
-        if disk_size_num > 50000000:
-            raise VMmanagerException("Could not create VM: disk can't be greater than 50 Go")
-
-        r = self._run_command('qemu-img create -f qcow2 {}/disk.img {}'.format(self.vms_home + '/' + name, disk_size))
-        if r.returncode != 0:
-            os.rmdir(self.vms_home + '/' + name)
+        # Metadata is preallocated so that guest writes don't have to grow the allocation tables
+        try:
+            r = self._run_command(['qemu-img', 'create', '-f', 'qcow2', '-o', 'preallocation=metadata,cluster_size=64K',
+                                   vm_dir + '/disk.img', disk_size])
+        except OSError:
+            # qemu-img can't be executed, don't leave the directory behind
+            r = None
+        if r != 0:
+            os.rmdir(vm_dir)
             raise VMmanagerException("Could not create disk")
 
         # Write MAC address
-        with open(self.vms_home + '/' + name + '/mac_addr', 'w') as f:
+        with open(vm_dir + '/mac_addr', 'w') as f:
             f.write(mac)
+        self._mac_cache.pop(name, None)
 
-        self.vms[name] = {'mac': mac}
+        self._locked(self._register_vm, name, vm_dir, mac)
 
         return 0
 
+    def _map(self, func, specs, action):
+        """
+        Call func(*spec) for each spec from a pool of threads
+        :param func: Single VM operation (callable)
+        :param specs: Arguments of each call, VM name first (list of tuples)
+        :param action: Operation name used in error messages (string)
+        :return: A list of (name, error) in specs order, error is None or the VMmanagerException raised
+        :raise: VMmanagerException if the same VM appears twice
+        """
+        names = [spec[0] for spec in specs]
+        if len(set(names)) != len(names):
+            raise VMmanagerException("Could not {} VMs: duplicate name".format(action))
+        if not specs:
+            return []
+
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Loaded once here rather than concurrently by the workers
+        if self._vm_macs is None:
+            self._load_vms()
+
+        def call(spec):
+            # Every VM gets its own result, a system error must not abort the others
+            try:
+                func(*spec)
+            except VMmanagerException as e:
+                return e
+            except OSError as e:
+                return VMmanagerException("Could not {} VM: {}".format(action, e.strerror or e))
+            return None
+
+        self._lock = threading.Lock()
+        try:
+            with ThreadPoolExecutor(max_workers=min((os.cpu_count() or 1) * 2, len(specs))) as executor:
+                errors = list(executor.map(call, specs))
+        finally:
+            self._lock = None
+
+        return list(zip(names, errors))
+
+    def create_many(self, specs):
+        """
+        Create several VMs concurrently
+        :param specs: (name, disk_size) of each VM (list of tuples)
+        :return: A list of (name, error) in specs order, error is None or the VMmanagerException raised
+        :raise: VMmanagerException if the same VM appears twice
+        """
+        return self._map(self.create, specs, 'create')
+
     def delete(self, name, force=False):
         """
         Delete an existing VM
         :param name: VM name (string)
-        :param force: Force deletion if VM is running (boolean)
+        :param force: Force deletion if VM is running or if its disk backs clones (boolean)
         :return: 0 if ok
         :raise: VMmanagerException if error occurs
         """
-        if not self._validate_vm_name(name):
-            raise VMmanagerException("Could not delete VM: Invalid name")
-
         # Check existing VM
-        if name not in self.vms:
-            raise VMmanagerException("Could not delete VM: doesn't exist")
+        dir_fd, running = self._resolve(name, 'delete')
+
+        # Overlays can't be read without their backing disk
+        overlays = self._overlays(name)
+        if overlays and not force:
+            raise VMmanagerException("Could not delete VM: disk is backing {}".format(', '.join(overlays)))
 
         # Check running status and eventually stop it
-        if self.is_running(name):
+        if running:
             if not force:
                 raise VMmanagerException('VM is running.')
             else:
                 self.stop(name, True)
 
-        # Remove files
-        os.remove(self.vms_home + '/' + name + '/disk.img')
-        os.remove(self.vms_home + '/' + name + '/mac_addr')
-        os.rmdir(self.vms_home + '/' + name)
-
-        self.vms.pop(name)
+        # Remove files relative to the VM directory descriptor, without resolving the full path each time
+        vm_dir = self._vm_dir(name)
+        os.remove('disk.img', dir_fd=dir_fd)
+        os.remove('mac_addr', dir_fd=dir_fd)
+        self._release_backing(name, dir_fd)
+        try:
+            os.rmdir(vm_dir)
+        except OSError as e:
+            # Extra files (snapshots, pid file...) left in the directory
+            if e.errno != errno.ENOTEMPTY:
+                raise
+            import shutil
+            shutil.rmtree(vm_dir)
+
+        fd = self._dir_fds.pop(name, None)
+        if fd is not None:
+            os.close(fd)
+
+        self._macs.pop(name)
+        self._paths.pop(name, None)
+        self._running.discard(name)
+        self._running_checked.pop(name, None)
+        self._mac_cache.pop(name, None)
 
         return 0
 
-    def run(self, name, ram_size):
+    def _release_backing(self, name, dir_fd):
+        """
+        Remove the dependency of an overlay clone on its backing VM, if any
+        :param name: VM name (string)
+        :param dir_fd: VM directory file descriptor (int)
+        :return: None
+        """
+        try:
+            with open('backing', 'r', opener=lambda path, flags: os.open(path, flags, dir_fd=dir_fd)) as f:
+                backing = f.readline().strip()
+        except OSError:
+            return
+
+        if self._validate_vm_name(backing):
+            try:
+                os.remove(self._vm_dir(backing) + '/overlay.' + name)
+            except OSError:
+                pass
+        os.remove('backing', dir_fd=dir_fd)
+
+    def _check_overlays(self, name, force, action):
+        """
+        Refuse to boot a VM whose disk backs clones: guest writes would corrupt their overlays
+        :param name: VM name (string)
+        :param force: Boot anyway (boolean)
+        :param action: Operation name for error messages (string)
+        :return: None
+        :raise: VMmanagerException if the disk backs clones and force isn't set
+        """
+        if force:
+            return
+        overlays = self._overlays(name)
+        if overlays:
+            raise VMmanagerException("Could not {} VM: disk is backing {}".format(action, ', '.join(overlays)))
+
+    def run(self, name, ram_size, force=False):
         """
         Run an existing VM with ram_size amount of memory
         :param name: VM name (string)
         :param ram_size: Amount of memory allocated (string) (ex: 1G)
+        :param force: Run even if its disk backs overlay clones (boolean)
         :return: 0 if ok
         :raise: VMmanagerException if error occurs
         """
-        if not self._validate_vm_name(name):
-            raise VMmanagerException("Could not run VM: Invalid name")
-
         if not self._validate_size(ram_size):
             raise VMmanagerException("Could not run VM: Invalid memory size")
 
+        self._check_kvm_group()
+
         # Check existing VM
-        if name not in self.vms:
-            raise VMmanagerException("Could not run VM: doesn't exist")
+        dir_fd, running = self._resolve(name, 'run')
 
         # Check running status
-        if self.is_running(name):
+        if running:
             raise VMmanagerException("Could not run VM: already running")
 
+        self._check_overlays(name, force, 'run')
+
         # Fetch MAC address
-        mac = self.vms[name]['mac']
+        mac = self._macs[name]
 
         # Run VM
-        cmd = 'kvm -m {mem} {img}.img -display none -monitor unix:{path}/monitor,server,nowait ' \
-              '-k fr -netdev bridge,id=hn0 -device virtio-net-pci,netdev=hn0,id=nic1,mac={mac} -daemonize' \
-            .format(mem=ram_size,
-                    img=self.vms_home + '/' + name + '/' + name,
-                    path=self.vms_home + '/' + name,
-                    mac=mac)
+        vm_dir = self._vm_dir(name)
+        cmd = [*_KVM_RUN_ARGS, '-m', ram_size, vm_dir + '/disk.img',
+               '-monitor', 'unix:{}/monitor,server,nowait'.format(vm_dir), '-pidfile', vm_dir + '/pid',
+               '-device', 'virtio-net-pci,netdev=hn0,id=nic1,mac={}'.format(mac)]
 
         r = self._run_command(cmd)
-        if r.returncode != 0:
-            raise VMmanagerException("Could not run VM: kvm returns {}".format(r.returncode))
+        if r != 0:
+            raise VMmanagerException("Could not run VM: kvm returns {}".format(r))
+
+        self._running.add(name)
+        self._running_checked[name] = time.monotonic()
 
         return 0
 
-    def install(self, name, ram_size, cd_rom, display='curses'):
+    def run_many(self, specs):
+        """
+        Run several VMs concurrently
+        :param specs: (name, ram_size) or (name, ram_size, force) of each VM (list of tuples)
+        :return: A list of (name, error) in specs order, error is None or the VMmanagerException raised
+        :raise: VMmanagerException if the same VM appears twice
+        """
+        return self._map(self.run, specs, 'run')
+
+    def install(self, name, ram_size, cd_rom, display='curses', force=False):
         """
         Install an existing VM with ram_size amount of memory booting from cd_rom image file
         !!! THIS IS A BLOCKING OPERATION THAT REQUIRE USER INTERACTION !!!
@@ -262,44 +822,42 @@ class VMmanager:
         :param ram_size: Amount of memory allocated (string) (ex: 1G)
         :param cd_rom: .iso file path to boot from
         :param display: Select the display type ('curses' or 'nographic')
+        :param force: Install even if its disk backs overlay clones (boolean)
         :return: 0 if ok
         :raise: VMmanagerException if error occurs
         """
-        if not self._validate_vm_name(name):
-            raise VMmanagerException("Could not install VM: Invalid name")
-
         if not self._validate_size(ram_size):
             raise VMmanagerException("Could not install VM: Invalid memory size")
 
         if display == 'curses':
-            display = '-display curses'
+            display = ['-display', 'curses']
         elif display == 'nographic':
-            display = '-nographic'
+            display = ['-nographic']
         else:
             raise VMmanagerException("Could not install VM: Invalid display type")
 
+        self._check_kvm_group()
+
         # Check existing VM
-        if name not in self.vms:
-            raise VMmanagerException("Could not install VM: doesn't exist")
+        dir_fd, running = self._resolve(name, 'install')
 
         # Check running status
-        if self.is_running(name):
+        if running:
             raise VMmanagerException("Could not install VM: already running")
 
+        self._check_overlays(name, force, 'install')
+
         # Fetch MAC address
-        mac = self.vms[name]['mac']
+        mac = self._macs[name]
 
         # Run VM
-        cmd = 'kvm -m {mem} {img}.img -cdrom {cdrom} -boot d {display} -k fr -netdev bridge,id=hn0 ' \
-              '-device virtio-net-pci,netdev=hn0,id=nic1,mac={mac}'.format(mem=ram_size,
-                                                                           img=self.vms_home + '/' + name + '/' + name,
-                                                                           cdrom=cd_rom,
-                                                                           display=display,
-                                                                           mac=mac)
+        vm_dir = self._vm_dir(name)
+        cmd = [*_KVM_INSTALL_ARGS, *display, '-m', ram_size, vm_dir + '/disk.img', '-cdrom', cd_rom,
+               '-pidfile', vm_dir + '/pid', '-device', 'virtio-net-pci,netdev=hn0,id=nic1,mac={}'.format(mac)]
 
         r = self._run_command(cmd)
-        if r.returncode != 0:
-            raise VMmanagerException("Could not install VM: kvm returns {}".format(r.returncode))
+        if r != 0:
+            raise VMmanagerException("Could not install VM: kvm returns {}".format(r))
 
         return 0
 
@@ -311,56 +869,215 @@ class VMmanager:
         :return: 0 if ok
         :raise: VMmanagerException if error occurs
         """
-        if not self._validate_vm_name(name):
-            raise VMmanagerException("Could not stop VM: Invalid name")
-
         # Check existing VM
-        if name not in self.vms:
-            raise VMmanagerException("Could not stop VM: doesn't exist")
+        dir_fd, running = self._resolve(name, 'stop')
 
         # Check running status
-        if not self.is_running(name):
+        if not running:
             raise VMmanagerException("Could not stop VM: not running")
 
-        # Connecting to UNIX socket (QEMU monitor)
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        try:
-            sock.connect(self.vms_home + '/' + name + '/monitor')
-        except socket.error as e:
-            raise VMmanagerException('Could not stop VM: error with UNIX socket')
-
+        # Watch the VM directory before asking for shutdown, so that the monitor removal can't be missed
+        watch = self._watch_deletions(name)
+        sock = None
         try:
-            sock.sendall('system_powerdown'.encode('ascii'))
+            # Connecting to UNIX socket (QEMU monitor)
+            import socket
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self._vm_path(name, 'monitor'))
+                sock.sendall('system_powerdown\n'.encode('ascii'))
+            except OSError as e:
+                raise VMmanagerException('Could not stop VM: error with UNIX socket')
+
+            self._wait_stopped(name, sock, self._STOP_TIMEOUT, watch)
+
+            # Check VM state
+            self._running_checked.pop(name, None)
+            if self.is_running(name):
+                if not force:
+                    raise VMmanagerException('Could not stop VM')
+                else:
+                    # Force shutdown, signalling the pid written by kvm rather than matching every command line
+                    try:
+                        with open(self._vm_path(name, 'pid'), 'r') as f:
+                            pid = int(f.readline())
+                    except (OSError, ValueError):
+                        pid = None
+
+                    if pid is not None and pid > 0:
+                        import signal
+                        try:
+                            os.kill(pid, signal.SIGTERM)
+                        except ProcessLookupError:
+                            pass
+                        self._wait_stopped(name, None, 5, watch)
+                    else:
+                        # VM started without a pid file (by an older version)
+                        self._run_command(['pkill', '-f', 'qemu-system-x86_64.*{}.*'.format(name)])
         finally:
-            sock.close()
+            if sock is not None:
+                sock.close()
+            if watch is not None:
+                os.close(watch)
 
-        time.sleep(5)
+        return 0
 
-        # Check VM state
-        if self.is_running(name):
-            if not force:
-                raise VMmanagerException('Could not stop VM')
-            else:
-                # Force shutdown
-                self._run_command("pkill -f 'qemu-system-x86_64.*{}.*'".format(name))
+    def _watch_deletions(self, name):
+        """
+        Watch a VM directory for deleted entries with inotify
+        :param name: VM name (string)
+        :return: inotify file descriptor, None if inotify isn't available
+        """
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+
+        # IN_DELETE
+        if libc.inotify_add_watch(fd, os.fsencode(self._vm_dir(name)), 0x200) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _wait_stopped(self, name, sock, timeout, watch=None):
+        """
+        Wait for a VM to stop, waking up on monitor activity or after exponentially growing delays
+        :param name: VM name (string)
+        :param sock: Connected monitor socket (socket.socket), None to only poll
+        :param timeout: Maximum time to wait in seconds (float)
+        :param watch: inotify file descriptor from _watch_deletions (optional), makes polling unnecessary
+        :return: True if VM stopped, False on timeout
+        """
+        import selectors
 
-        return 0
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+
+        selector = selectors.DefaultSelector()
+        if sock is not None:
+            selector.register(sock, selectors.EVENT_READ)
+        if watch is not None:
+            selector.register(watch, selectors.EVENT_READ)
+        try:
+            while True:
+                self._running_checked.pop(name, None)
+                if not self.is_running(name):
+                    return True
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+
+                # The socket file removal wakes us up when watched, no need to poll
+                wait = remaining if watch is not None else min(delay, remaining)
+                delay = min(delay * 2, 0.5)
+                if selector.get_map():
+                    for key, events in selector.select(wait):
+                        if key.fileobj is watch:
+                            try:
+                                os.read(watch, 4096)
+                            except BlockingIOError:
+                                pass
+                            continue
+
+                        try:
+                            data = sock.recv(4096)
+                        except OSError:
+                            data = b''
+                        if data == b'':
+                            # QEMU closed the monitor, it is exiting and will remove the socket file
+                            selector.unregister(sock)
+                else:
+                    time.sleep(wait)
+        finally:
+            selector.close()
 
-    def clone(self, name, new_name):
+    def _copy_disk(self, src, dst):
+        """
+        Copy a disk image, sharing its extents (reflink) on filesystems that support it (Btrfs, XFS...)
+        and otherwise copying its data ranges inside the kernel, holes are kept as holes
+        :param src: Source file path (string)
+        :param dst: Destination file path (string)
+        :return: None
+        """
+        import shutil
+
+        if os.path.islink(src):
+            shutil.copyfile(src=src, dst=dst, follow_symlinks=False)
+            return
+
+        import fcntl
+
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            # FICLONE
+            try:
+                fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())
+                return
+            except OSError:
+                pass
+
+            src_fd = fsrc.fileno()
+            dst_fd = fdst.fileno()
+            size = os.fstat(src_fd).st_size
+            use_sendfile = True
+            offset = 0
+            while offset < size:
+                # Next data range, the whole remaining file if holes can't be queried
+                try:
+                    start = os.lseek(src_fd, offset, os.SEEK_DATA)
+                    end = os.lseek(src_fd, start, os.SEEK_HOLE)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        break
+                    start, end = offset, size
+                except AttributeError:
+                    start, end = offset, size
+
+                while start < end:
+                    if use_sendfile:
+                        # sendfile writes at the current offset of the destination
+                        os.lseek(dst_fd, start, os.SEEK_SET)
+                        try:
+                            copied = os.sendfile(dst_fd, src_fd, start, end - start)
+                        except OSError:
+                            # sendfile to a regular file isn't supported everywhere, go on in user space
+                            use_sendfile = False
+                            continue
+                    else:
+                        copied = os.pwrite(dst_fd, os.pread(src_fd, min(end - start, 1 << 20), start), start)
+                    if copied == 0:
+                        break
+                    start += copied
+                offset = end
+
+            # Trailing hole
+            os.ftruncate(dst_fd, size)
+
+    def clone(self, name, new_name, full=False):
         """
         Clone an existing VM
+        By default the clone's disk is a qcow2 overlay backed by the source disk, which must then be kept
         :param name: VM name to clone (string)
         :param new_name: VM name of the clone (string)
+        :param full: Make an independent full copy of the disk instead of an overlay (bool)
         :return: 0 if ok
         :raise: VMmanagerException if error occurs
         """
-        if not self._validate_vm_name(name) or not self._validate_vm_name(new_name):
+        if not self._validate_vm_name(new_name):
             raise VMmanagerException("Could not clone VM: Invalid name")
 
+        self._check_kvm_group()
+
         # Check existing VM
-        if name not in self.vms:
+        if name not in self._macs:
             raise VMmanagerException("Could not clone VM: doesn't exist")
-        if os.path.exists(self.vms_home + '/' + new_name):
+        vm_dir = self._vm_dir(name)
+        new_vm_dir = self._vm_dir(new_name)
+        if self._vm_exists(new_name):
             raise VMmanagerException("Could not clone VM: file exist")
 
         # Check running status
@@ -368,179 +1085,285 @@ class VMmanager:
             raise VMmanagerException("Could not clone VM: VM is running")
 
         # Generate MAC address
-        mac = self._create_mac_addr()
+        mac = self._locked(self._create_mac_addr)
         if mac == '':
             raise VMmanagerException("Could not clone VM: no MAC address available (up to 255 VMs allowed)")
 
         # Create directory
-        os.mkdir(self.vms_home + '/' + new_name)
+        try:
+            os.mkdir(new_vm_dir)
+        except FileExistsError:
+            # Created concurrently since the check
+            raise VMmanagerException("Could not clone VM: file exist")
 
         # Clone disk
-        shutil.copyfile(src=self.vms_home + '/' + name + '/disk.img',
-                        dst=self.vms_home + '/' + new_name + '/disk.img',
-                        follow_symlinks=False)
+        src_disk = vm_dir + '/disk.img'
+        new_disk = new_vm_dir + '/disk.img'
+        if full and os.path.exists(vm_dir + '/backing'):
+            # A byte copy of an overlay would still point at its backing disk, flatten it into a standalone image
+            try:
+                r = self._run_command(['qemu-img', 'convert', '-O', 'qcow2', src_disk, new_disk])
+            except OSError:
+                r = None
+            if r != 0:
+                try:
+                    os.remove(new_disk)
+                except OSError:
+                    pass
+                os.rmdir(new_vm_dir)
+                raise VMmanagerException("Could not clone disk")
+        elif full:
+            self._copy_disk(src_disk, new_disk)
+        else:
+            # Recorded on both sides: the source is protected from then on, and the clone can release it
+            marker = vm_dir + '/overlay.' + new_name
+            open(marker, 'w').close()
+            try:
+                r = self._run_command(['qemu-img', 'create', '-f', 'qcow2', '-b', src_disk, '-F', 'qcow2', new_disk])
+            except OSError:
+                r = None
+            if r != 0:
+                os.remove(marker)
+                os.rmdir(new_vm_dir)
+                raise VMmanagerException("Could not clone disk")
+            with open(new_vm_dir + '/backing', 'w') as f:
+                f.write(name)
 
         # Write MAC address
-        with open(self.vms_home + '/' + new_name + '/mac_addr', 'w') as f:
+        with open(new_vm_dir + '/mac_addr', 'w') as f:
             f.write(mac)
+        self._mac_cache.pop(new_name, None)
 
-        self.vms[new_name] = {'mac': mac}
+        self._locked(self._register_vm, new_name, new_vm_dir, mac)
 
         return 0
 
 
-# MAIN
-if __name__ == "__main__":
-    def usage():
-        usage = """Usage: {} <operation> [-h] [arguments...]
-<operation> = list|create|clone|delete|status|run|install|stop
+# CLI
+def _validate_vm_name(name):
+    import argparse
+    if _VM_NAME_RE.fullmatch(name) is None:
+        raise argparse.ArgumentTypeError('Invalid VM name. Must be [a-zA-Z0-9_-]{1,32}')
+    return name
+
+
+def _validate_size(value):
+    import argparse
+    if _SIZE_RE.fullmatch(value) is None:
+        raise argparse.ArgumentTypeError('Invalid size.')
+    return value
+
+
+def _validate_cdrom(value):
+    import argparse
+    if not os.path.isfile(value):
+        raise argparse.ArgumentTypeError('Not a file.')
+    return value
+
+
+def _make_list_parser(status_flag=True):
+    import argparse
+    parser = argparse.ArgumentParser(prog='list', description='List all VMs')
+    if status_flag:
+        parser.add_argument('--status', action='store_true', help='Include status')
+    parser.add_argument('--name', required=False, type=_validate_vm_name, help='Existing VM name')
+    return parser
+
+
+def _make_status_parser():
+    return _make_list_parser(status_flag=False)
+
+
+def _make_refresh_parser():
+    import argparse
+    return argparse.ArgumentParser(prog='refresh', description='Rescan VMs, discarding the saved scan')
+
+
+def _make_create_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog='create', description='Create new VMs')
+    parser.add_argument('--name', required=True, nargs='+', type=_validate_vm_name, help='VM names')
+    parser.add_argument('--disk', required=True, type=_validate_size,
+                        help='Disk size (understand suffix M and G)')
+    parser.add_argument('--parallel', action='store_true', help='Create the VMs concurrently')
+    return parser
+
+
+def _make_delete_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog='delete', description='Delete an existing VM')
+    parser.add_argument('--name', required=True, type=_validate_vm_name, help='Existing VM name')
+    parser.add_argument('-f', dest='force', action='store_true',
+                        help='Force operation if VM is running or backs overlay clones')
+    return parser
+
+
+def _make_clone_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog='clone', description='Clone an existing VM')
+    parser.add_argument('--name', required=True, type=_validate_vm_name, help='Existing VM name')
+    parser.add_argument('--new-name', dest='new', required=True, type=_validate_vm_name, help='Name of the clone')
+    parser.add_argument('--full', action='store_true',
+                        help='Copy the whole disk instead of creating an overlay backed by the existing VM disk')
+    return parser
+
+
+def _make_run_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog='run', description='Launch VMs')
+    parser.add_argument('--name', required=True, nargs='+', type=_validate_vm_name, help='Existing VM names')
+    parser.add_argument('--ram', required=True, type=_validate_size,
+                        help='Memory size (understand suffix M and G)')
+    parser.add_argument('--parallel', action='store_true', help='Launch the VMs concurrently')
+    parser.add_argument('-f', dest='force', action='store_true',
+                        help='Force operation even if the VM disk backs overlay clones')
+    return parser
+
+
+def _make_install_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog='install', description='Install an existing VM (BLOCKING OPERATION)')
+    parser.add_argument('--name', required=True, type=_validate_vm_name, help='Existing VM name')
+    parser.add_argument('--ram', required=True, type=_validate_size,
+                        help='Memory size (understand suffix M and G)')
+    parser.add_argument('--cd-rom', dest='cdrom', required=True, type=_validate_cdrom,
+                        help='Image file to boot from')
+    parser.add_argument('--display', required=False, default='curses', choices=['curses', 'nographic'],
+                        help="Select the display type between 'curses' and 'nographic'")
+    parser.add_argument('-f', dest='force', action='store_true',
+                        help='Force operation even if the VM disk backs overlay clones')
+    return parser
+
+
+def _make_stop_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog='stop', description='Stop a running VM')
+    parser.add_argument('--name', required=True, type=_validate_vm_name, help='Existing VM name')
+    parser.add_argument('-f', dest='force', action='store_true', help='Force operation')
+    return parser
+
+
+def _print_vms(vms_list, status):
+    for v in vms_list:
+        if status:
+            print('{name} ({mac}): {status}'.format(name=v['name'], mac=v['mac'], status=v['status']))
+        else:
+            print('{name} ({mac})'.format(name=v['name'], mac=v['mac']))
 
-""".format(sys.argv[0])
-        sys.stderr.write(usage)
-        sys.exit(1)
 
-    def _validate_vm_name(name):
-        regex = re.compile('[a-zA-Z0-9_-]{1,32}')
-        if regex.fullmatch(name) is None:
-            raise argparse.ArgumentTypeError('Invalid VM name. Must be [a-zA-Z0-9_-]{1,32}')
-        return name
+def _do_list(manager, args):
+    _print_vms(manager.list(args.name, args.status), args.status)
 
-    def _validate_size(value):
-        regex = re.compile('[1-9][0-9]*[MG]')
-        if regex.fullmatch(value) is None:
-            raise argparse.ArgumentTypeError('Invalid size.')
-        return value
 
-    def _validate_cdrom(value):
-        if not os.path.isfile(value):
-            raise argparse.ArgumentTypeError('Not a file.')
-        return value
+def _do_status(manager, args):
+    _print_vms(manager.list(args.name, True), True)
 
-    if len(sys.argv) < 2:
-        usage()
 
-    try:
-        manager = VMmanager(getpass.getuser())
-    except VMmanagerException as e:
-        sys.stderr.write(e.args[0] + '\n')
-        sys.exit(1)
+def _do_many(single, many, names, extra, parallel, done):
+    if not parallel:
+        for name in names:
+            single(name, *extra)
+            print(done.format(name))
+        return
 
-    operation = sys.argv.pop(1)
-    args = sys.argv[1:]
-
-    if operation == 'list' or operation == 'status':
-        parser = argparse.ArgumentParser(prog='list', description='List all VMs')
-        if operation == 'list':
-            parser.add_argument('--status', action='store_true', help='Include status')
-        parser.add_argument('--name', required=False, type=_validate_vm_name, help='Existing VM name')
-        args = parser.parse_args(args)
-        if operation == 'list':
-            status = args.status
+    errors = []
+    for name, error in many([(name, *extra) for name in names]):
+        if error is None:
+            print(done.format(name))
         else:
-            status = True
+            errors.append('{}: {}'.format(name, error.args[0]))
+    if errors:
+        raise VMmanagerException('\n'.join(errors))
 
-        try:
-            vms_list = manager.list(args.name, status)
-        except VMmanagerException as e:
-            sys.stderr.write(e.args[0] + '\n')
-            sys.exit(1)
 
-        for v in vms_list:
-            if status:
-                print('{name} ({mac}): {status}'.format(name=v['name'], mac=v['mac'], status=v['status']))
-            else:
-                print('{name} ({mac})'.format(name=v['name'], mac=v['mac']))
+def _do_refresh(manager, args):
+    manager.refresh()
+    print('{} VMs found'.format(len(manager.vms)))
 
-    elif operation == 'create':
-        parser = argparse.ArgumentParser(prog='create', description='Create a new VM')
-        parser.add_argument('--name', required=True, type=_validate_vm_name, help='VM name')
-        parser.add_argument('--disk', required=True, type=_validate_size,
-                            help='Disk size (understand suffix M and G)')
-        args = parser.parse_args(args)
 
-        try:
-            manager.create(args.name, args.disk)
-        except VMmanagerException as e:
-            sys.stderr.write(e.args[0] + '\n')
-            sys.exit(1)
+def _do_create(manager, args):
+    _do_many(manager.create, manager.create_many, args.name, (args.disk,), args.parallel, '{} created successfully')
 
-        print('{} created successfully'.format(args.name))
 
-    elif operation == 'delete':
-        parser = argparse.ArgumentParser(prog='delete', description='Delete an existing VM')
-        parser.add_argument('--name', required=True, type=_validate_vm_name, help='Existing VM name')
-        parser.add_argument('-f', dest='force', action='store_true', help='Force operation if VM is running')
-        args = parser.parse_args(args)
+def _do_delete(manager, args):
+    manager.delete(args.name, args.force)
+    print('{} removed'.format(args.name))
 
-        try:
-            manager.delete(args.name, args.force)
-        except VMmanagerException as e:
-            sys.stderr.write(e.args[0] + '\n')
-            sys.exit(1)
 
-        print('{} removed'.format(args.name))
+def _do_clone(manager, args):
+    manager.clone(args.name, args.new, args.full)
+    print('{} cloned'.format(args.name))
 
-    elif operation == 'clone':
-        parser = argparse.ArgumentParser(prog='clone', description='Clone an existing VM')
-        parser.add_argument('--name', required=True, type=_validate_vm_name, help='Existing VM name')
-        parser.add_argument('--new-name', dest='new', required=True, type=_validate_vm_name, help='Name of the clone')
-        args = parser.parse_args(args)
 
-        try:
-            manager.clone(args.name, args.new)
-        except VMmanagerException as e:
-            sys.stderr.write(e.args[0] + '\n')
-            sys.exit(1)
+def _do_run(manager, args):
+    _do_many(manager.run, manager.run_many, args.name, (args.ram, args.force), args.parallel, '{} started')
 
-        print('{} cloned'.format(args.name))
 
-    elif operation == 'run':
-        parser = argparse.ArgumentParser(prog='run', description='Launch a VM')
-        parser.add_argument('--name', required=True, type=_validate_vm_name, help='Existing VM name')
-        parser.add_argument('--ram', required=True, type=_validate_size,
-                            help='Memory size (understand suffix M and G)')
-        args = parser.parse_args(args)
+def _do_install(manager, args):
+    manager.install(args.name, args.ram, args.cdrom, args.display, args.force)
+    print('{} install terminated'.format(args.name))
 
-        try:
-            manager.run(args.name, args.ram)
-        except VMmanagerException as e:
-            sys.stderr.write(e.args[0] + '\n')
-            sys.exit(1)
-
-        print('{} started'.format(args.name))
-
-    elif operation == 'install':
-        parser = argparse.ArgumentParser(prog='install', description='Install an existing VM (BLOCKING OPERATION)')
-        parser.add_argument('--name', required=True, type=_validate_vm_name, help='Existing VM name')
-        parser.add_argument('--ram', required=True, type=_validate_size,
-                            help='Memory size (understand suffix M and G)')
-        parser.add_argument('--cd-rom', dest='cdrom', required=True, type=_validate_cdrom,
-                            help='Image file to boot from')
-        parser.add_argument('--display', required=False, default='curses', choices=['curses', 'nographic'],
-                            help="Select the display type between 'curses' and 'nographic'")
-        args = parser.parse_args(args)
 
-        try:
-            manager.install(args.name, args.ram, args.cdrom, args.display)
-        except VMmanagerException as e:
-            sys.stderr.write(e.args[0] + '\n')
-            sys.exit(1)
+def _do_stop(manager, args):
+    manager.stop(args.name, args.force)
+    print('{} stopped'.format(args.name))
 
-        print('{} install terminated'.format(args.name))
 
-    elif operation == 'stop':
-        parser = argparse.ArgumentParser(prog='stop', description='Stop a running VM')
-        parser.add_argument('--name', required=True, type=_validate_vm_name, help='Existing VM name')
-        parser.add_argument('-f', dest='force', action='store_true', help='Force operation')
-        args = parser.parse_args(args)
+# Operation -> (parser factory, handler)
+_HANDLERS = {
+    'list': (_make_list_parser, _do_list),
+    'status': (_make_status_parser, _do_status),
+    'refresh': (_make_refresh_parser, _do_refresh),
+    'create': (_make_create_parser, _do_create),
+    'delete': (_make_delete_parser, _do_delete),
+    'clone': (_make_clone_parser, _do_clone),
+    'run': (_make_run_parser, _do_run),
+    'install': (_make_install_parser, _do_install),
+    'stop': (_make_stop_parser, _do_stop),
+}
+
+_PARSERS = {}
 
-        try:
-            manager.stop(args.name, args.force)
-        except VMmanagerException as e:
-            sys.stderr.write(e.args[0] + '\n')
-            sys.exit(1)
 
-        print('{} stopped'.format(args.name))
+def _get_parser(operation):
+    """
+    Return the argument parser of an operation, built on first use and then reused
+    :param operation: Operation name (string)
+    :return: argparse.ArgumentParser, None if operation is unknown
+    """
+    if operation not in _PARSERS:
+        if operation not in _HANDLERS:
+            return None
+        _PARSERS[operation] = _HANDLERS[operation][0]()
+    return _PARSERS[operation]
 
-    else:
+
+# MAIN
+if __name__ == "__main__":
+    def usage():
+        usage = """Usage: {} <operation> [-h] [arguments...]
+<operation> = list|create|clone|delete|status|refresh|run|install|stop
+
+""".format(sys.argv[0])
+        sys.stderr.write(usage)
+        sys.exit(1)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in _HANDLERS:
         usage()
+
+    import getpass
+
+    try:
+        manager = VMmanager(getpass.getuser())
+    except VMmanagerException as e:
+        sys.stderr.write(e.args[0] + '\n')
+        sys.exit(1)
+
+    operation = sys.argv[1]
+    args = _get_parser(operation).parse_args(sys.argv[2:])
+
+    try:
+        _HANDLERS[operation][1](manager, args)
+    except VMmanagerException as e:
+        sys.stderr.write(e.args[0] + '\n')
+        sys.exit(1)